@@ -1,3 +1,3 @@
 from .about import __author__, __name__, __version__  # noqa F401
-from .score import bert_score, BERTScore, load_model  # noqa F401
+from .score import bert_score, BERTScore, PrecomputedReferences, load_model  # noqa F401
 from .tasks import plot_bertscore_detail, lineplot  # noqa F401
@@ -3,8 +3,12 @@ import numpy as np
 import os
 import torch
 import torch.nn.functional as F
+import warnings
 from collections import Counter
-from transformers import BertModel, BertTokenizer
+from queue import Full, Queue
+from threading import Event, Thread
+from transformers import BertModel, BertTokenizerFast
+from transformers.modeling_outputs import BaseModelOutput
 from tqdm import tqdm
 
 
@@ -16,7 +20,8 @@ def bert_score(bert_tokenizer, bert_model, references, candidates,
         bert_model (transformers`s Pretrained models)
         references (list of str) : True sentences
         candidates (list of str) : Generated sentences
-        idf (torch.nn.Embedding or None) : IDF weights
+        idf (torch.nn.Embedding, torch.tensor or None) : IDF weights
+            (n vocab, 1) embedding or (n vocab,) tensor
         output_layer_index (int)
             The index of last BERT layer which is used for token embedding
         rescale_base (float) : 0 <= rescale_base < 1
@@ -42,28 +47,82 @@ def bert_score(bert_tokenizer, bert_model, references, candidates,
            tensor([0.5252, 0.8333, 0.8768, 0.6904, 0.8235]),
            tensor([0.5721, 0.8134, 0.8768, 0.6904, 0.7934]))
     """
-    # tokenization
-    refer_ids, refer_attention_mask, refer_weight_mask = sents_to_tensor(bert_tokenizer, references)
-    candi_ids, candi_attention_mask, candi_weight_mask = sents_to_tensor(bert_tokenizer, candidates)
+    # tokenization. IDF weights replace the token masks
+    mask_special_tokens = idf is None
+    refer_inputs = sents_to_tensor(bert_tokenizer, references, mask_special_tokens)
+    candi_inputs = sents_to_tensor(bert_tokenizer, candidates, mask_special_tokens)
+    return bert_score_from_tensors(
+        bert_model, refer_inputs, candi_inputs,
+        idf, output_layer_index, rescale_base)
+
+
+def bert_score_from_tensors(bert_model, refer_inputs, candi_inputs,
+                            idf=None, output_layer_index=-1, rescale_base=0, refer_embeds=None,
+                            cosine_dtype=None):
+    """
+    Args:
+        bert_model (transformers`s Pretrained models)
+        refer_inputs (tuple of torch.tensor) : Tokenized references
+            (input_ids, attention_mask, weight_mask), output of `sents_to_tensor`
+        candi_inputs (tuple of torch.tensor) : Tokenized candidates
+            (input_ids, attention_mask, weight_mask), output of `sents_to_tensor`
+        idf (torch.nn.Embedding, torch.tensor or None) : IDF weights
+        output_layer_index (int)
+            The index of last BERT layer which is used for token embedding
+        rescale_base (float) : 0 <= rescale_base < 1
+            Adjust (R-BERTScore - base) / (1 - base)
+        refer_embeds (torch.tensor or None) : (B, K_i, D)
+            L2 normalized embeddings of references. If given, only candidates are encoded
+        cosine_dtype (torch.dtype or None)
+            dtype of normalized embeddings in cosine computation. If None, it follows BERT output
 
-    # BERT embedding
-    refer_embeds = bert_forwarding(bert_model, refer_ids, refer_attention_mask, output_layer_index)
-    candi_embeds = bert_forwarding(bert_model, candi_ids, candi_attention_mask, output_layer_index)
+    Returns:
+        R (torch.tensor) : R-BERTScore
+        P (torch.tensor) : P-BERTScore
+        F (torch.tensor) : F-BERTScore
+    """
+    refer_ids, refer_attention_mask, refer_weight_mask = refer_inputs
+    candi_ids, candi_attention_mask, candi_weight_mask = candi_inputs
+    refer_normalized = refer_embeds is not None
+
+    if refer_normalized:
+        candi_embeds = bert_forwarding(bert_model, candi_ids, candi_attention_mask, output_layer_index)
+    else:
+        # BERT embedding of references and candidates with one forward
+        n_refers, refer_len = refer_ids.size()
+        candi_len = candi_ids.size(1)
+        max_len = max(refer_len, candi_len)
+        input_ids = torch.cat([_pad_right(refer_ids, max_len), _pad_right(candi_ids, max_len)])
+        attention_mask = torch.cat([
+            _pad_right(refer_attention_mask, max_len), _pad_right(candi_attention_mask, max_len)])
+        embeds = bert_forwarding(bert_model, input_ids, attention_mask, output_layer_index)
+        refer_embeds = embeds[:n_refers, :refer_len]
+        candi_embeds = embeds[n_refers:, :candi_len]
 
     # Compute bert RPF
     R, P, F = compute_RPF(
         refer_embeds, candi_embeds,
         refer_weight_mask, candi_attention_mask,
         refer_ids, candi_ids,
-        idf, rescale_base)
+        idf, rescale_base,
+        refer_attention_mask, candi_attention_mask,
+        refer_normalized, cosine_dtype)
     return R, P, F
 
 
-def sents_to_tensor(bert_tokenizer, input_sents):
+def _pad_right(tensor, length):
+    """Pad (batch, seq len) `tensor` with 0 to (batch, `length`)"""
+    return F.pad(tensor, (0, length - tensor.size(1)))
+
+
+def sents_to_tensor(bert_tokenizer, input_sents, mask_special_tokens=True):
     """
     Args:
         bert_tokenizer (transformers.PreTrainedTokenizer)
         input_sents (list of str)
+        mask_special_tokens (Boolean)
+            If False, `token_mask` is same with `attention_mask`.
+            It skips masking cls / sep tokens when the mask is replaced with IDF weights
 
     Returns:
         padded_input_ids (torch.LongTensor) : (batch, max seq len)
@@ -93,13 +152,61 @@ def sents_to_tensor(bert_tokenizer, input_sents):
                    [0, 1, 1, 1, 0, 0, 0],
                    [0, 1, 1, 1, 0, 0, 0]]))
     """
-    inputs = bert_tokenizer.batch_encode_plus(input_sents, padding=True)
-    padded_input_ids = torch.LongTensor(inputs['input_ids'])
-    attention_mask = torch.LongTensor(inputs['attention_mask'])
+    inputs = bert_tokenizer.batch_encode_plus(input_sents, padding=True, return_tensors='pt')
+    return _inputs_to_tensor(bert_tokenizer, inputs, mask_special_tokens)
+
+
+def ids_to_tensor(bert_tokenizer, input_ids, mask_special_tokens=True, pin_memory=False):
+    """
+    Same with `sents_to_tensor`, but for already tokenized sentences
 
-    zero_mask = torch.zeros(attention_mask.size(), dtype=torch.long)
-    token_mask = torch.where(padded_input_ids == bert_tokenizer.cls_token_id, zero_mask, attention_mask)
-    token_mask = torch.where(padded_input_ids == bert_tokenizer.sep_token_id, zero_mask, token_mask)
+    Args:
+        bert_tokenizer (transformers.PreTrainedTokenizer)
+        input_ids (list of list of int) : Token ids, including cls / sep tokens
+        mask_special_tokens (Boolean)
+            If False, `token_mask` is same with `attention_mask`.
+        pin_memory (Boolean)
+            If True, `padded_input_ids` and `attention_mask` are allocated in page-locked memory
+
+    Returns:
+        padded_input_ids (torch.LongTensor) : (batch, max seq len)
+        attention_mask (torch.LongTensor) : (batch, max seq len)
+        token_mask (torch.LongTensor) : (batch, max seq len)
+            True token is 1 and padded / cls / sep token is 0
+    """
+    # `tokenizer.pad` is slow with fast tokenizers
+    padded_input_ids = _pad_sequence(
+        [torch.tensor(ids) for ids in input_ids], bert_tokenizer.pad_token_id, pin_memory)
+    lengths = torch.tensor([len(ids) for ids in input_ids])
+    attention_mask = torch.empty_like(padded_input_ids, pin_memory=pin_memory)
+    attention_mask.copy_(torch.arange(padded_input_ids.size(1)) < lengths[:, None])
+    inputs = {'input_ids': padded_input_ids, 'attention_mask': attention_mask}
+    return _inputs_to_tensor(bert_tokenizer, inputs, mask_special_tokens)
+
+
+def _pad_sequence(sequences, padding_value=0, pin_memory=False):
+    """
+    Same with `torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True)`, but if `pin_memory`,
+    the padded batch is allocated in page-locked memory, so that it is staged for
+    asynchronous copy to GPU without another copy. Tensors on GPU are not pinned.
+    """
+    first = sequences[0]
+    padded = torch.full(
+        (len(sequences), max(len(seq) for seq in sequences)) + first.shape[1:], padding_value,
+        dtype=first.dtype, device=first.device, pin_memory=pin_memory and first.device.type == 'cpu')
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = seq
+    return padded
+
+
+def _inputs_to_tensor(bert_tokenizer, inputs, mask_special_tokens):
+    padded_input_ids = inputs['input_ids']
+    attention_mask = inputs['attention_mask']
+    if not mask_special_tokens:
+        return padded_input_ids, attention_mask, attention_mask
+
+    special = (padded_input_ids != bert_tokenizer.cls_token_id) & (padded_input_ids != bert_tokenizer.sep_token_id)
+    token_mask = attention_mask * special.long()
     return padded_input_ids, attention_mask, token_mask
 
 
@@ -118,22 +225,30 @@ def bert_forwarding(bert_model, input_ids, attention_mask=None, output_layer_ind
             B : batch size
             K : maximum sequence length in `input_ids`
             D : BERT embedding dim
+            Hidden states stay on the device of `bert_model`
     """
     device = next(bert_model.parameters()).device
     input_ids = input_ids.to(device)
     if attention_mask is not None:
         attention_mask = attention_mask.to(device)
 
-    with torch.no_grad():
-        _, _, hidden_states = bert_model(
-            input_ids, attention_mask=attention_mask, output_hidden_states=True)
+    # Hidden states of all layers are returned only when a layer other than the last is required
+    output_hidden_states = output_layer_index != -1
+    with torch.inference_mode():
+        outputs = bert_model(
+            input_ids, attention_mask=attention_mask,
+            output_hidden_states=output_hidden_states, return_dict=True)
+    if not output_hidden_states:
+        return outputs.last_hidden_state
     if output_layer_index == 'all':
-        return [h.cpu() for h in hidden_states]
-    return hidden_states[output_layer_index].cpu()
+        return list(outputs.hidden_states)
+    return outputs.hidden_states[output_layer_index]
 
 
 def compute_RPF(refer_embeds, candi_embeds, refer_weight_mask, candi_weight_mask,
-                refer_ids=None, candi_ids=None, idf=None, rescale_base=0):
+                refer_ids=None, candi_ids=None, idf=None, rescale_base=0,
+                refer_attention_mask=None, candi_attention_mask=None, refer_normalized=False,
+                cosine_dtype=None):
     """
     Args:
         refer_embeds (torch.tensor) : (B, K_i, D)
@@ -148,9 +263,16 @@ def compute_RPF(refer_embeds, candi_embeds, refer_weight_mask, candi_weight_mask
             token mask or IDF weight mask
         candi_weight_mask (torch.tensor) : (batch, max seq len)
             token mask or IDF weight mask
-        idf (torch.nn.Embedding or None) : IDF weights
+        idf (torch.nn.Embedding, torch.tensor or None) : IDF weights
         rescale_base (float) : 0 <= rescale_base < 1
             Adjust (R-BERTScore - base) / (1 - base)
+        refer_attention_mask (torch.tensor or None) : (batch, max seq len)
+        candi_attention_mask (torch.tensor or None) : (batch, max seq len)
+            If given, padded tokens are excluded from both max-cosine and weights,
+            and the scores do not depend on the padding length of batch
+        refer_normalized (Boolean) : If True, `refer_embeds` is already L2 normalized
+        cosine_dtype (torch.dtype or None)
+            dtype of normalized embeddings in cosine computation. If None, it follows `refer_embeds`
 
     Returns:
         R (torch.tensor) : R-BERTScore
@@ -158,24 +280,73 @@ def compute_RPF(refer_embeds, candi_embeds, refer_weight_mask, candi_weight_mask
         F (torch.tensor) : F-BERTScore
 
     """
-    pairwise_cosine = compute_pairwise_cosine(refer_embeds, candi_embeds)
-    R_max, _ = pairwise_cosine.max(dim=2)
-    P_max, _ = pairwise_cosine.max(dim=1)
+    device = refer_embeds.device
+    if (refer_attention_mask is not None) and (candi_attention_mask is not None):
+        refer_attention_mask = refer_attention_mask.to(device)
+        candi_attention_mask = candi_attention_mask.to(device)
+    R_max, P_max = compute_max_cosine(
+        refer_embeds, candi_embeds, refer_attention_mask, candi_attention_mask,
+        refer_normalized=refer_normalized, dtype=cosine_dtype)
+    # weighted average in fp32 even if cosine is computed with fp16
+    R_max = R_max.float()
+    P_max = P_max.float()
 
     if (idf is not None) and (refer_ids is not None) and (candi_ids is not None):
         refer_weight_mask = apply_idf(refer_ids, idf)
         candi_weight_mask = apply_idf(candi_ids, idf)
+    refer_weight_mask = refer_weight_mask.to(device).float()
+    candi_weight_mask = candi_weight_mask.to(device).float()
+    if (refer_attention_mask is not None) and (candi_attention_mask is not None):
+        refer_weight_mask = refer_weight_mask * refer_attention_mask
+        candi_weight_mask = candi_weight_mask * candi_attention_mask
+
+    return _finalize_rpf(R_max, P_max, refer_weight_mask, candi_weight_mask, float(rescale_base))
 
-    R_max = rescaling(R_max, rescale_base)
-    P_max = rescaling(P_max, rescale_base)
 
-    R = (R_max * refer_weight_mask).sum(axis=1) / refer_weight_mask.sum(axis=1)
-    P = (P_max * candi_weight_mask).sum(axis=1) / candi_weight_mask.sum(axis=1)
+def _compile(function):
+    """
+    Compile `function` with `torch.compile` (PyTorch >= 2.0) or TorchScript.
+    If `torch.compile` is not usable in this environment (e.g. no C++ compiler),
+    it falls back to eager `function` at the first call with a warning.
+    """
+    if not hasattr(torch, 'compile'):
+        return torch.jit.script(function)
+    try:
+        compiled = torch.compile(function, dynamic=True)
+    except RuntimeError:
+        return function
+    from torch._dynamo.exc import TorchDynamoException
+
+    def wrapper(*args):
+        nonlocal compiled
+        try:
+            return compiled(*args)
+        except TorchDynamoException as e:
+            # Dynamo / Inductor errors, e.g. no C++ compiler for the backend
+            warnings.warn(f'torch.compile of {function.__name__} failed, fall back to eager: {e}')
+            compiled = function
+            return function(*args)
+    return wrapper
+
+
+def _finalize_rpf(R_max, P_max, refer_weight_mask, candi_weight_mask, rescale_base: float):
+    """
+    Rescaling, weighted average and F1 of R / P, fused into a few kernels by compiler
+    """
+    # weights of empty sentence sum to 0
+    R = torch.einsum('bi,bi->b', R_max, refer_weight_mask) / refer_weight_mask.sum(dim=1).clamp_min(1e-9)
+    P = torch.einsum('bi,bi->b', P_max, candi_weight_mask) / candi_weight_mask.sum(dim=1).clamp_min(1e-9)
+    # rescaling is affine, so rescaling weighted average is same with weighted average of rescaled
+    R = (R - rescale_base) / (1 - rescale_base)
+    P = (P - rescale_base) / (1 - rescale_base)
     F = 2 * (R * P) / (R + P)
     return R, P, F
 
 
-def compute_pairwise_cosine(refer_embeds, candi_embeds):
+_finalize_rpf = _compile(_finalize_rpf)
+
+
+def compute_pairwise_cosine(refer_embeds, candi_embeds, dtype=None):
     """
     Args:
         refer_embeds (torch.tensor) : (B, K_i, D)
@@ -186,6 +357,8 @@ def compute_pairwise_cosine(refer_embeds, candi_embeds):
             B : batch size
             K_r : maximum sequence length in `candi_embeds`
             D : BERT embedding dim
+        dtype (torch.dtype or None)
+            dtype of normalized embeddings in cosine computation. If None, it follows inputs
 
     Returns:
         pairwise_cosine (torch.tensor) : (B, K_i, K_r)
@@ -196,21 +369,83 @@ def compute_pairwise_cosine(refer_embeds, candi_embeds):
         >>> compute_pairwise_cosine(input1, input2).size()
         $ torch.Size([3, 4, 7])
     """
-    def normalize(embeds):
-        embeds.div_(torch.norm(embeds, dim=-1).unsqueeze(-1))
-        return embeds
+    return _cosine(_normalize(refer_embeds, dtype), _normalize(candi_embeds, dtype))
+
+
+def compute_max_cosine(refer_embeds, candi_embeds, refer_attention_mask=None,
+                       candi_attention_mask=None, tile_size=64, refer_normalized=False, dtype=None):
+    """
+    Compute row-wise and column-wise maximum of pairwise cosine
+    without materializing (B, K_i, K_r) matrix.
+    It computes cosine of `tile_size` reference tokens at once.
 
-    refer_embeds = normalize(refer_embeds)
-    candi_embeds = normalize(candi_embeds)
-    pairwise_cosine = torch.bmm(refer_embeds, candi_embeds.permute(0, 2, 1))
-    return pairwise_cosine
+    Args:
+        refer_embeds (torch.tensor) : (B, K_i, D)
+        candi_embeds (torch.tensor) : (B, K_r, D)
+        refer_attention_mask (torch.tensor or None) : (B, K_i)
+        candi_attention_mask (torch.tensor or None) : (B, K_r)
+            If given, cosine with padded tokens is ignored
+        tile_size (int) : The number of reference tokens in a tile
+        refer_normalized (Boolean) : If True, `refer_embeds` is already L2 normalized
+        dtype (torch.dtype or None)
+            dtype of normalized embeddings in cosine computation. If None, it follows inputs
+            torch.float16 uses tensor cores on CUDA
+
+    Returns:
+        R_max (torch.tensor) : (B, K_i)
+        P_max (torch.tensor) : (B, K_r)
+
+    Examples::
+        >>> input1 = torch.randn(3, 4, 5)
+        >>> input2 = torch.randn(3, 7, 5)
+        >>> R_max, P_max = compute_max_cosine(input1, input2)
+        >>> R_max.size(), P_max.size()
+        $ (torch.Size([3, 4]), torch.Size([3, 7]))
+    """
+    if refer_normalized:
+        refer_embeds = refer_embeds if dtype is None else refer_embeds.to(dtype)
+    else:
+        refer_embeds = _normalize(refer_embeds, dtype)
+    candi_embeds = _normalize(candi_embeds, dtype)
+    masking = (refer_attention_mask is not None) and (candi_attention_mask is not None)
+    if masking:
+        refer_valid = refer_attention_mask.bool().unsqueeze(2)
+        candi_valid = candi_attention_mask.bool().unsqueeze(1)
+
+    R_max, P_max = [], None
+    for b in range(0, refer_embeds.size(1), tile_size):
+        e = b + tile_size
+        sim = _cosine(refer_embeds[:, b: e], candi_embeds)
+        if masking:
+            sim = sim.masked_fill(~(refer_valid[:, b: e] & candi_valid), -1)
+        R_max.append(sim.max(dim=2)[0])
+        P_tile = sim.max(dim=1)[0]
+        P_max = P_tile if P_max is None else torch.maximum(P_max, P_tile)
+    R_max = torch.cat(R_max, dim=1)
+    return R_max, P_max
+
+
+def _normalize(embeds, dtype=None):
+    """
+    L2 normalize `embeds`. The output is written directly as `dtype` (default: dtype of `embeds`)
+    """
+    norm = embeds.norm(dim=-1, keepdim=True).clamp_min_(1e-12)
+    if dtype is None:
+        dtype = embeds.dtype
+    return (embeds / norm).to(dtype)
+
+
+def _cosine(refer_normalized, candi_normalized):
+    """Pairwise cosine (B, K_i, K_r) of L2 normalized embeddings"""
+    # batched GEMM without permuting `candi_normalized`
+    return torch.einsum('bid,bjd->bij', refer_normalized, candi_normalized)
 
 
 def apply_idf(ids, idf_embed):
     """
     Args:
         ids (torch.tensor) : (batch, max seq len)
-        idf_embed (torch.nn.Embedding) : (n vocab, 1)
+        idf_embed (torch.nn.Embedding or torch.tensor) : (n vocab, 1) or (n vocab,)
 
     Returns:
         embedded (torch.tensor) : (batch, max seq len)
@@ -229,7 +464,9 @@ def apply_idf(ids, idf_embed):
         $ tensor([[0.0000, 0.5000, 0.2500, 0.3000, 0.2500, 0.3000, 0.0000, 0.0000],
                   [0.0000, 0.2500, 0.3000, 0.2500, 0.3000, 0.0000, 0.0000, 0.0000]])
     """
-    return idf_embed(ids).squeeze(dim=2)
+    if isinstance(idf_embed, torch.nn.Embedding):
+        idf_embed = idf_embed.weight.detach().view(-1)
+    return idf_embed.to(ids.device)[ids]
 
 
 def rescaling(scores, base):
@@ -253,49 +490,286 @@ def rescaling(scores, base):
     return (scores - base) / (1 - base)
 
 
+class CUDAGraphEncoder(torch.nn.Module):
+    """
+    Wrapper of BERT encoder which replays the forward with CUDA graphs.
+
+    A graph is captured for each (batch size, seq len) at the first call with that shape.
+    The seq len is rounded up to a multiple of `length_step`, so the length-sorted
+    batches of `BERTScore.score` share a few graphs.
+    Only `last_hidden_state` is computed with graphs. If hidden states of all layers
+    are required or the capture fails, it runs `encoder` as usual.
+
+    The attention mask is given to `encoder` as a (batch, 1, seq len) tensor.
+    `BertModel` expands such a mask without inspecting its values, whereas the 2D mask
+    is checked on the host (e.g. `torch.all(mask == 1)` for SDPA attention), which
+    is not capturable.
+
+    The returned `last_hidden_state` is a view of the static output of the graph.
+    All graphs share one memory pool, so it may be overwritten by the next call
+    with any shape. Use or copy it before the next call.
+
+    Args:
+        encoder (transformers`s Pretrained models) : Encoder on CUDA device
+        length_step (int) : Padding unit of seq len
+        n_warmup (int) : The number of forwards before capture
+    """
+    def __init__(self, encoder, length_step=64, n_warmup=3):
+        super().__init__()
+        self.encoder = encoder
+        self.length_step = length_step
+        self.n_warmup = n_warmup
+        self._graphs = {}
+        self._pool = None
+        self._failed = False
+
+    def forward(self, input_ids, attention_mask=None, output_hidden_states=False, return_dict=True):
+        if output_hidden_states or (attention_mask is None) or self._failed:
+            return self.encoder(
+                input_ids, attention_mask=attention_mask,
+                output_hidden_states=output_hidden_states, return_dict=True)
+
+        batch_size, length = input_ids.size()
+        max_length = self.encoder.config.max_position_embeddings
+        padded_length = min(math.ceil(length / self.length_step) * self.length_step, max_length)
+        key = (batch_size, padded_length)
+        if key not in self._graphs:
+            try:
+                self._graphs[key] = self._capture(batch_size, padded_length)
+            except RuntimeError as e:
+                # e.g. operations which synchronize with CPU are not capturable
+                warnings.warn(f'CUDA graph capture failed, fall back to eager forward: {e}')
+                self._failed = True
+                return self.forward(input_ids, attention_mask)
+
+        graph, static_ids, static_mask, static_out = self._graphs[key]
+        static_ids[:, :length].copy_(input_ids)
+        static_mask[:, 0, :length].copy_(attention_mask)
+        static_mask[:, 0, length:].zero_()
+        graph.replay()
+        return BaseModelOutput(last_hidden_state=static_out[:, :length])
+
+    def _capture(self, batch_size, length):
+        device = next(self.encoder.parameters()).device
+        static_ids = torch.zeros((batch_size, length), dtype=torch.long, device=device)
+        static_mask = torch.ones((batch_size, 1, length), dtype=self.encoder.dtype, device=device)
+
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.n_warmup):
+                self.encoder(static_ids, attention_mask=static_mask, return_dict=True)
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        # graphs are replayed one by one, so they share a memory pool
+        if self._pool is None:
+            self._pool = torch.cuda.graph_pool_handle()
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self._pool):
+            static_out = self.encoder(
+                static_ids, attention_mask=static_mask, return_dict=True).last_hidden_state
+        return graph, static_ids, static_mask, static_out
+
+
+class PrecomputedReferences:
+    """
+    References tokenized by `BERTScore.precompute_references`
+
+    Attributes:
+        references (list of str) : True sentences
+        input_ids (list of list of int) : Token ids of `references`
+        embeds (list of torch.tensor or None) : L2 normalized BERT embeddings of `references`
+            Each tensor is (seq len, D), without padding
+        owner (BERTScore or None) : `BERTScore` which tokenized (and encoded) `references`
+    """
+    def __init__(self, references, input_ids, embeds=None, owner=None):
+        self.references = references
+        self.input_ids = input_ids
+        self.embeds = embeds
+        self.owner = owner
+
+    def __len__(self):
+        return len(self.references)
+
+
 class BERTScore:
-    def __init__(self, model_name_or_path='beomi/kcbert-base', best_layer=-1, idf_path=None, rescale_base=0, device=None):
+    def __init__(self, model_name_or_path='beomi/kcbert-base', best_layer=-1, idf_path=None, rescale_base=0,
+                 device=None, fp16=True, quantize=False, cuda_graph=False):
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.device = device
+        self.device = torch.device(device)
         if isinstance(model_name_or_path, tuple):
             self.tokenizer, self.encoder = model_name_or_path
         else:
             self.tokenizer, self.encoder = load_model(model_name_or_path, best_layer)
-        self.encoder = self.encoder.to(device)
+        # moved and cast in place. A (tokenizer, encoder) tuple given by the caller is modified too
+        self.encoder = self.encoder.to(self.device).eval()
+        # half precision is only faster with CUDA
+        self.fp16 = fp16 and self.device.type == 'cuda'
+        if self.fp16:
+            self.encoder = self.encoder.half()
+        # cosine in fp16 uses tensor cores; otherwise keep fp32 for reproducible scores
+        self._cosine_dtype = torch.float16 if self.fp16 else torch.float32
+        # int8 dynamic quantization of linear layers for CPU inference. It is lossy, so opt-in
+        self.quantize = quantize and self.device.type == 'cpu'
+        if self.quantize:
+            quantized = _quantize_dynamic(self.encoder)
+            self.quantize = quantized is not self.encoder
+            self.encoder = quantized
+        # Encoder used in `score`. Batches are scattered to every GPU if there are multiple GPUs
+        self._forward_encoder = self.encoder
+        if self.device.type == 'cuda' and not self.device.index and torch.cuda.device_count() > 1:
+            if cuda_graph:
+                warnings.warn('cuda_graph is ignored with multiple GPUs, which are used with DataParallel')
+            self._forward_encoder = torch.nn.DataParallel(self.encoder)
+        elif cuda_graph and self.device.type == 'cuda':
+            self._forward_encoder = CUDAGraphEncoder(self.encoder)
         self.rescale_base = rescale_base
         self.idf = load_idf(idf_path, self.tokenizer)
+        # dense IDF vector for direct lookup
+        self.idf_vec = self.idf.weight.detach().view(-1).contiguous().to(self.device)
 
     def __call__(self, references, candidates, batch_size=128, retrain_idf=True, verbose=True):
         return self.score(references, candidates, batch_size, retrain_idf, verbose)
 
     def score(self, references, candidates, batch_size=128, retrain_idf=True, verbose=True):
+        """
+        Args:
+            references (list of str or PrecomputedReferences) : True sentences
+                `PrecomputedReferences` from `precompute_references` skips tokenization and encoding of references
+            candidates (list of str) : Generated sentences
+            batch_size (int) : Batch size, default = 128
+            retrain_idf (Boolean) : Kept for compatibility. Scores are weighted with `self.idf`,
+                so IDF is not trained from `references`
+            verbose (Boolean)
+
+        Returns:
+            F (list of float) : F-BERTScore
+        """
+        refer_embeds = None
+        if isinstance(references, PrecomputedReferences):
+            if references.owner is not self:
+                raise ValueError(
+                    '`references` was precomputed by another BERTScore. '
+                    'Token ids and embeddings depend on its tokenizer and encoder')
+            refer_ids = references.input_ids
+            refer_embeds = references.embeds
+            references = references.references
+        else:
+            refer_ids = self._tokenize(references)
+        if len(references) != len(candidates):
+            raise ValueError(
+                'The number of `references` and `candidates` must be same\n'
+                f'len(references)={len(references)}, len(candidates)={len(candidates)}')
+        candi_ids = self._tokenize(candidates)
+
         n_examples = len(references)
         n_batch = math.ceil(n_examples / batch_size)
+
+        # Sort pairs by length so that each batch is padded to similar lengths
+        lengths = [max(len(r), len(c)) for r, c in zip(refer_ids, candi_ids)]
+        sorted_indices = np.argsort(lengths, kind='stable')
+
+        # Spread examples evenly over batches, so that the last batch is not a tiny one
+        # which under-utilizes the GEMM kernels. Batch sizes differ by at most one
+        bounds = [step * n_examples // n_batch for step in range(n_batch + 1)] if n_batch else [0]
+
+        # Page-locked inputs are copied to GPU asynchronously
+        pin_memory = self.device.type == 'cuda'
+
+        def to_tensor(step):
+            indices = sorted_indices[bounds[step]: bounds[step + 1]]
+            refer_inputs = ids_to_tensor(
+                self.tokenizer, [refer_ids[i] for i in indices], mask_special_tokens=False, pin_memory=pin_memory)
+            candi_inputs = ids_to_tensor(
+                self.tokenizer, [candi_ids[i] for i in indices], mask_special_tokens=False, pin_memory=pin_memory)
+            refer_embeds_batch = None
+            if refer_embeds is not None:
+                refer_embeds_batch = _pad_sequence([refer_embeds[i] for i in indices], pin_memory=pin_memory)
+            return refer_inputs, candi_inputs, refer_embeds_batch
+
+        def to_device(inputs):
+            return tuple(tensor.to(self.device, non_blocking=True) for tensor in inputs)
+
+        # Pad next batches in background while BERT encodes current batch
+        prefetcher = _prefetch(map(to_tensor, range(n_batch)))
+        batch_iterator = prefetcher
         if verbose:
-            step_iterator = tqdm(range(n_batch), desc='Calculating BERTScore', total=n_batch)
-        else:
-            step_iterator = range(n_batch)
+            batch_iterator = tqdm(batch_iterator, desc='Calculating BERTScore', total=n_batch)
+
+        # Scores are written at their input positions on device,
+        # and copied to CPU once after the loop
+        F = torch.full((n_examples,), float('nan'), device=self.device)
+        positions = torch.as_tensor(sorted_indices, device=self.device)
+        try:
+            for step, (refer_inputs, candi_inputs, refer_embeds_batch) in enumerate(batch_iterator):
+                if refer_embeds_batch is not None:
+                    refer_embeds_batch = refer_embeds_batch.to(self.device, non_blocking=True)
+                _, _, F_batch = bert_score_from_tensors(
+                    self._forward_encoder, to_device(refer_inputs), to_device(candi_inputs),
+                    idf=self.idf_vec, rescale_base=self.rescale_base, refer_embeds=refer_embeds_batch,
+                    cosine_dtype=self._cosine_dtype)
+                F[positions[bounds[step]: bounds[step + 1]]] = F_batch.detach()
+        finally:
+            # stop the background thread even if encoding fails (e.g. CUDA OOM)
+            prefetcher.close()
+        return F.cpu().tolist()
+
+    def precompute_references(self, references, batch_size=128, encode=True, storage_device='cpu', verbose=True):
+        """
+        Tokenize and encode references once. Normalized embeddings of the references
+        are stored on `storage_device`, and `score` encodes only candidates with them.
+        The embeddings take (total number of tokens) x D x 2 bytes with fp16,
+        so keep them on CPU (default) or skip encoding for a large set of references.
 
-        if retrain_idf:
-            idf = train_idf(self.tokenizer, references, batch_size=1000, verbose=verbose)
-            idf = idf_numpy_to_embed(idf)
-        else:
-            idf = self.idf
+        Args:
+            references (list of str) : True sentences
+            batch_size (int) : Batch size, default = 128
+            encode (Boolean) : If False, only tokenize references, and `score` encodes them
+            storage_device (str or torch.device) : Device where the embeddings are stored.
+                `score` copies them to `self.device` batch by batch.
+                If None, they are kept on `self.device`
+            verbose (Boolean)
 
-        F = []
-        for step in step_iterator:
-            b = step * batch_size
-            e = min((step + 1) * batch_size, n_examples)
-            refer_batch = references[b: e]
-            candi_batch = candidates[b: e]
+        Returns:
+            precomputed (PrecomputedReferences)
+                It can be used instead of `references` in `score`,
+                when the same references are scored with many candidates
 
-            _, _, F_batch = bert_score(
-                self.tokenizer, self.encoder,
-                refer_batch, candi_batch,
-                idf=self.idf, rescale_base=self.rescale_base)
-            F += F_batch.detach().numpy().tolist()
-        return F
+        Examples::
+            >>> bertscore = BERTScore()
+            >>> precomputed = bertscore.precompute_references(references)
+            >>> F_a = bertscore(precomputed, candidates_a)
+            >>> F_b = bertscore(precomputed, candidates_b)
+        """
+        input_ids = self._tokenize(references)
+        if not encode:
+            return PrecomputedReferences(references, input_ids, owner=self)
+        if storage_device is None:
+            storage_device = self.device
+        n_examples = len(references)
+        sorted_indices = np.argsort([len(ids) for ids in input_ids], kind='stable')
+        begin_index = range(0, n_examples, batch_size)
+        if verbose:
+            begin_index = tqdm(begin_index, desc='Encoding references', total=math.ceil(n_examples / batch_size))
+
+        embeds = [None] * n_examples
+        for b in begin_index:
+            indices = sorted_indices[b: b + batch_size]
+            ids, attention_mask, _ = ids_to_tensor(
+                self.tokenizer, [input_ids[i] for i in indices], mask_special_tokens=False)
+            batch_embeds = _normalize(
+                bert_forwarding(self._forward_encoder, ids, attention_mask), self._cosine_dtype).to(storage_device)
+            for i, embed in zip(indices, batch_embeds):
+                # copy, so that each embedding does not keep the whole padded batch
+                embeds[i] = embed[:len(input_ids[i])].clone()
+        return PrecomputedReferences(references, input_ids, embeds, owner=self)
+
+    def _tokenize(self, sents):
+        # fast tokenizer fails with empty input
+        if len(sents) == 0:
+            return []
+        return self.tokenizer.batch_encode_plus(sents)['input_ids']
 
     def plot_bertscore_detail(self, reference, candidate,
         idf=None, height='auto', width='auto', title=None, return_gridplot=True):
@@ -343,6 +817,62 @@ class BERTScore:
         return figure
 
 
+def _quantize_dynamic(encoder):
+    """
+    int8 dynamic quantization of `torch.nn.Linear` layers in `encoder`.
+    If the quantization API is not available in installed PyTorch, it returns `encoder` as is.
+    """
+    quantization = getattr(getattr(torch, 'ao', None), 'quantization', None)
+    if quantization is None:
+        quantization = getattr(torch, 'quantization', None)
+    quantize_dynamic = getattr(quantization, 'quantize_dynamic', None)
+    if quantize_dynamic is None:
+        warnings.warn('Dynamic quantization is not available in installed PyTorch. Encoder is not quantized')
+        return encoder
+    return quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _prefetch(iterable, size=2):
+    """
+    Iterate `iterable` in a background thread, keeping at most `size` items ahead.
+    Exceptions in the background thread are raised at the consumer.
+    When the generator is closed (or the consumer raises), the background thread stops.
+    """
+    queue = Queue(maxsize=size)
+    stop = Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+        put((end, None))
+
+    Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 MODEL_TO_BEST_LAYER = {
     'beomi/kcbert-base': 4,
     'monologg/kobert': 2,
@@ -353,10 +883,10 @@ MODEL_TO_BEST_LAYER = {
 
 def load_model(model_name_or_path, best_layer=-1):
     if os.path.exists(model_name_or_path):
-        tokenizer = BertTokenizer.from_pretrained(model_name_or_path)
+        tokenizer = BertTokenizerFast.from_pretrained(model_name_or_path)
         encoder = BertModel.from_pretrained(model_name_or_path)
     elif model_name_or_path in MODEL_TO_BEST_LAYER:
-        tokenizer = BertTokenizer.from_pretrained(model_name_or_path)
+        tokenizer = BertTokenizerFast.from_pretrained(model_name_or_path)
         encoder = BertModel.from_pretrained(model_name_or_path)
     else:
         raise ValueError(
@@ -450,8 +980,9 @@ def train_idf(bert_tokenizer, references, batch_size=1000, verbose=True):
         counter.update(subcounter)
 
     idf = np.ones(bert_tokenizer.vocab_size)
-    indices, df = zip(*counter.items())
-    idf[np.array(indices)] += np.array(df)
+    if counter:
+        indices, df = zip(*counter.items())
+        idf[np.array(indices)] += np.array(df)
     idf = 1 / idf
-    idf[np.array(bert_tokenizer.all_special_ids, dtype=np.int)] = 0
+    idf[np.array(bert_tokenizer.all_special_ids, dtype=int)] = 0
     return idf
@@ -140,8 +140,8 @@ def compute_average_l2_norm(bert_tokenizer, bert_model, references, model_name=N
         refer_ids, refer_attention_mask, refer_weight_mask = sents_to_tensor(bert_tokenizer, refer_batch)
         refer_embeds = bert_forwarding(bert_model, refer_ids, refer_attention_mask, output_layer_index='all')
         for layer in range(n_layers):
-            l2norm = torch.norm(refer_embeds[layer], p=2, dim=2)
-            l2norm = float(((l2norm * refer_weight_mask).sum()).detach())
+            l2norm = torch.norm(refer_embeds[layer].float(), p=2, dim=2)
+            l2norm = float(((l2norm * refer_weight_mask.to(l2norm.device)).sum()).detach())
             weight = float(refer_weight_mask.sum().detach())
             layer_l2norm[layer] += l2norm
             layer_weight[layer] += weight
@@ -296,9 +296,9 @@ def score_from_all_layers(bert_tokenizer, bert_model, references, candidates,
                 refer_ids, candi_ids,
                 idf, rescale_base
             )
-            R[layer].append(R_l.numpy())
-            P[layer].append(P_l.numpy())
-            F[layer].append(F_l.numpy())
+            R[layer].append(R_l.cpu().numpy())
+            P[layer].append(P_l.cpu().numpy())
+            F[layer].append(F_l.cpu().numpy())
 
     R = {layer: np.concatenate(array).tolist() for layer, array in R.items()}
     P = {layer: np.concatenate(array).tolist() for layer, array in P.items()}
@@ -372,7 +372,7 @@ def plot_bertscore_detail(reference, candidate, bert_tokenizer, bert_model, idf=
     # BERT embedding + Cosine
     refer_embed = bert_forwarding(bert_model, refer_ids, refer_attention_mask, output_layer_index)
     candi_embed = bert_forwarding(bert_model, candi_ids, candi_attention_mask, output_layer_index)
-    pairwise_cosine = compute_pairwise_cosine(refer_embed, candi_embed)[0].numpy()
+    pairwise_cosine = compute_pairwise_cosine(refer_embed, candi_embed)[0].float().cpu().numpy()
 
     # set height and width
     if height == 'auto':
@@ -389,8 +389,8 @@ def plot_bertscore_detail(reference, candidate, bert_tokenizer, bert_model, idf=
 
 
 def draw_pairwise_cosine(bert_tokenizer, refer_ids, candi_ids, pairwise_cosine, title=None, height=500, width=500):
-    refer_vocab = [bert_tokenizer.ids_to_tokens[idx] for idx in refer_ids[0][1: -1].numpy()]
-    candi_vocab = [bert_tokenizer.ids_to_tokens[idx] for idx in candi_ids[0][1: -1].numpy()]
+    refer_vocab = [bert_tokenizer.convert_ids_to_tokens(int(idx)) for idx in refer_ids[0][1: -1].numpy()]
+    candi_vocab = [bert_tokenizer.convert_ids_to_tokens(int(idx)) for idx in candi_ids[0][1: -1].numpy()]
 
     tooltips = [
         ('Reference token', '@refer'),
@@ -414,8 +414,8 @@ def draw_pairwise_cosine(bert_tokenizer, refer_ids, candi_ids, pairwise_cosine,
         for i_can, candi in enumerate(candi_ids[0][1: -1].numpy()):
             y.append(f'{i_ref}: {refer_vocab[i_ref]}')
             x.append(f'{i_can}: {candi_vocab[i_can]}')
-            refers.append(bert_tokenizer.ids_to_tokens[refer])
-            candis.append(bert_tokenizer.ids_to_tokens[candi])
+            refers.append(bert_tokenizer.convert_ids_to_tokens(int(refer)))
+            candis.append(bert_tokenizer.convert_ids_to_tokens(int(candi)))
             cos.append(pairwise_cosine[i_ref + 1, i_can + 1])
             cos_str.append(f'{pairwise_cosine[i_ref + 1, i_can + 1]:.3}')
     source = ColumnDataSource(data={
@@ -441,7 +441,7 @@ def draw_idf(bert_tokenizer, refer_ids, idf, height=500, width=50):
         ('Reference token', '@refer'),
         ('IDF', '@idf')
     ]
-    refer_vocab = [bert_tokenizer.ids_to_tokens[idx] for idx in refer_ids[0][1: -1].numpy()]
+    refer_vocab = [bert_tokenizer.convert_ids_to_tokens(int(idx)) for idx in refer_ids[0][1: -1].numpy()]
     yrange = [f'{i}: {refer_vocab[i]}' for i in range(refer_ids.size()[1] - 2)]
     xrange = ['IDF']
     p = figure(height=height, width=width, x_range=xrange, y_range=yrange, tooltips=tooltips, tools=[])
@@ -453,7 +453,7 @@ def draw_idf(bert_tokenizer, refer_ids, idf, height=500, width=50):
     idf_str = []
     for i_ref, refer in enumerate(refer_ids[0][1: -1].numpy()):
         y.append(f'{i_ref}: {refer_vocab[i_ref]}')
-        refers.append(bert_tokenizer.ids_to_tokens[refer])
+        refers.append(bert_tokenizer.convert_ids_to_tokens(int(refer)))
         idf_str.append(f'{idf[i_ref]:.3}')
     x = ['IDF'] * len(y)
     source = ColumnDataSource(data={
@@ -1,5 +1,52 @@
+import copy
+import pytest
+import random
+import threading
+import time
 import torch
-from KoBERTScore.score import compute_pairwise_cosine
+from transformers import BertConfig, BertModel, BertTokenizerFast
+from KoBERTScore.score import (
+    BERTScore, CUDAGraphEncoder, compute_pairwise_cosine, compute_max_cosine,
+    ids_to_tensor, sents_to_tensor, train_idf, _prefetch)
+
+
+WORDS = [chr(c) for c in range(ord('a'), ord('z') + 1)]
+
+
+@pytest.fixture(scope='module')
+def tiny_bert(tmp_path_factory):
+    vocab_path = tmp_path_factory.mktemp('tiny_bert') / 'vocab.txt'
+    vocab_path.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS))
+    tokenizer = BertTokenizerFast(str(vocab_path))
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=64)
+    encoder = BertModel(config).eval()
+    return tokenizer, encoder
+
+
+@pytest.fixture(scope='module')
+def sentence_pairs():
+    random.seed(0)
+
+    def sent():
+        return ' '.join(random.choice(WORDS) for _ in range(random.randint(1, 20)))
+    references = [sent() for _ in range(11)]
+    candidates = [sent() for _ in range(11)]
+    return references, candidates
+
+
+def naive_bertscore(tokenizer, encoder, reference, candidate):
+    """F-BERTScore of one pair, without padding and with uniform token weights"""
+    def embed(sent):
+        inputs = tokenizer(sent, return_tensors='pt')
+        with torch.no_grad():
+            return torch.nn.functional.normalize(encoder(**inputs).last_hidden_state[0], dim=-1)
+    cosine = embed(reference) @ embed(candidate).T
+    R = cosine.max(dim=1)[0].mean()
+    P = cosine.max(dim=0)[0].mean()
+    return float(2 * R * P / (R + P))
 
 
 def test_pairwise_cosine():
@@ -8,3 +55,117 @@ def test_pairwise_cosine():
     input2 = torch.randn(3, 7, 5)
     assert list(compute_pairwise_cosine(input1, input2).size()) == [3, 4, 7]
 
+
+def test_max_cosine():
+    torch.manual_seed(0)
+    input1 = torch.randn(3, 10, 5)
+    input2 = torch.randn(3, 7, 5)
+    pairwise_cosine = compute_pairwise_cosine(input1, input2)
+    R_max, P_max = compute_max_cosine(input1, input2, tile_size=3)
+    assert torch.allclose(R_max, pairwise_cosine.max(dim=2)[0])
+    assert torch.allclose(P_max, pairwise_cosine.max(dim=1)[0])
+
+
+def test_prefetch_stops_when_closed():
+    n_threads = threading.active_count()
+    batches = _prefetch(iter(range(100)), size=1)
+    assert next(batches) == 0
+    batches.close()
+    for _ in range(50):
+        if threading.active_count() == n_threads:
+            break
+        time.sleep(0.1)
+    assert threading.active_count() == n_threads
+
+
+def test_score_empty(tiny_bert):
+    bertscore = BERTScore(tiny_bert, device='cpu')
+    assert bertscore([], [], retrain_idf=False, verbose=False) == []
+
+
+def test_score_independent_of_batch_size(tiny_bert, sentence_pairs):
+    references, candidates = sentence_pairs
+    bertscore = BERTScore(tiny_bert, device='cpu')
+    scores = {
+        batch_size: bertscore(references, candidates, batch_size=batch_size, retrain_idf=False, verbose=False)
+        for batch_size in [1, 3, 8]
+    }
+    naive = [naive_bertscore(*tiny_bert, r, c) for r, c in zip(references, candidates)]
+    for batch_size in [1, 3, 8]:
+        assert scores[batch_size] == pytest.approx(naive, abs=1e-5)
+
+
+def test_score_default_arguments(tiny_bert, sentence_pairs):
+    references, candidates = sentence_pairs
+    bertscore = BERTScore(tiny_bert, device='cpu')
+    assert bertscore([], []) == []
+    expected = bertscore(references, candidates, retrain_idf=False, verbose=False)
+    assert bertscore(references, candidates) == pytest.approx(expected, abs=1e-6)
+
+
+def test_train_idf(tiny_bert, sentence_pairs):
+    tokenizer, _ = tiny_bert
+    idf = train_idf(tokenizer, sentence_pairs[0], verbose=False)
+    assert idf.shape == (tokenizer.vocab_size,)
+    assert (idf[tokenizer.all_special_ids] == 0).all()
+    # without references, every token except special tokens has df = 0
+    idf = train_idf(tokenizer, [], verbose=False)
+    n_special = len(tokenizer.all_special_ids)
+    assert sorted(idf.tolist()) == [0] * n_special + [1] * (len(idf) - n_special)
+
+
+def test_ids_to_tensor(tiny_bert, sentence_pairs):
+    tokenizer, _ = tiny_bert
+    references = sentence_pairs[0]
+    input_ids = tokenizer.batch_encode_plus(references)['input_ids']
+    for expected, tensor in zip(sents_to_tensor(tokenizer, references), ids_to_tensor(tokenizer, input_ids)):
+        assert torch.equal(expected, tensor)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='page-locked memory requires CUDA')
+def test_ids_to_tensor_pin_memory(tiny_bert, sentence_pairs):
+    tokenizer, _ = tiny_bert
+    input_ids = tokenizer.batch_encode_plus(sentence_pairs[0])['input_ids']
+    expected = ids_to_tensor(tokenizer, input_ids, mask_special_tokens=False)
+    pinned = ids_to_tensor(tokenizer, input_ids, mask_special_tokens=False, pin_memory=True)
+    for expected_tensor, tensor in zip(expected, pinned):
+        assert tensor.is_pinned() and torch.equal(expected_tensor, tensor)
+
+
+def test_score_length_mismatch(tiny_bert, sentence_pairs):
+    references, candidates = sentence_pairs
+    bertscore = BERTScore(tiny_bert, device='cpu')
+    with pytest.raises(ValueError):
+        bertscore(references, candidates[:2], batch_size=4, retrain_idf=False, verbose=False)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs require a CUDA device')
+def test_cuda_graph_encoder(tiny_bert, sentence_pairs):
+    tokenizer, encoder = tiny_bert
+    encoder = copy.deepcopy(encoder).cuda()
+    inputs = tokenizer(sentence_pairs[0], padding=True, return_tensors='pt').to('cuda')
+    graph_encoder = CUDAGraphEncoder(encoder, length_step=8)
+    with torch.inference_mode():
+        expected = encoder(**inputs, return_dict=True).last_hidden_state
+        output = graph_encoder(inputs['input_ids'], attention_mask=inputs['attention_mask'])
+    assert graph_encoder._graphs and not graph_encoder._failed
+    mask = inputs['attention_mask'].bool()
+    assert torch.allclose(output.last_hidden_state[mask], expected[mask], atol=1e-4)
+
+
+@pytest.mark.parametrize('encode', [True, False])
+def test_score_precomputed_references(tiny_bert, sentence_pairs, encode):
+    references, candidates = sentence_pairs
+    bertscore = BERTScore(tiny_bert, device='cpu')
+    precomputed = bertscore.precompute_references(references, batch_size=4, encode=encode, verbose=False)
+    assert (precomputed.embeds is not None) == encode
+    expected = bertscore(references, candidates, batch_size=3, retrain_idf=False, verbose=False)
+    scores = bertscore(precomputed, candidates, batch_size=3, retrain_idf=False, verbose=False)
+    assert scores == pytest.approx(expected, abs=1e-5)
+
+
+def test_score_precomputed_by_another(tiny_bert, sentence_pairs):
+    references, candidates = sentence_pairs
+    precomputed = BERTScore(tiny_bert, device='cpu').precompute_references(references, verbose=False)
+    with pytest.raises(ValueError):
+        BERTScore(tiny_bert, device='cpu')(precomputed, candidates, retrain_idf=False, verbose=False)